@@ -1,59 +1,236 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import hashlib
+import json
 import re
+import ssl
 import sys
 import time
 from pathlib import Path
 
+import aiofiles
+import aiohttp
+import certifi
+import orjson
 import requests
+import zstandard as zstd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 KWG_ENDPOINT = "https://stko-kwg.geog.ucsb.edu/graphdb/repositories/KWG"
 OUT_DIR = Path.home() / "Desktop" / "kwg_maine_cropland_by_county"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
-HEADERS_TTL = {"Accept": "text/turtle"}
-HEADERS_JSON = {"Accept": "application/sparql-results+json"}
+# Ask for gzip explicitly; both requests and aiohttp decompress it transparently.
+HEADERS_TTL = {"Accept": "text/turtle", "Accept-Encoding": "gzip"}
+HEADERS_JSON = {"Accept": "application/sparql-results+json", "Accept-Encoding": "gzip"}
 
-# If KWG SSL chain fails on your machine, keep verify=False.
-# If SSL works, set VERIFY_SSL=True.
-VERIFY_SSL = False
+# CA bundle used to verify the KWG certificate. If the KWG chain fails to
+# verify on your machine, save the server's certificate chain
+# (e.g. with `openssl s_client -showcerts`) and point this at that .pem file.
+CA_BUNDLE = certifi.where()
+SSL_CONTEXT = ssl.create_default_context(cafile=CA_BUNDLE)
+
+# Number of county CONSTRUCTs allowed in flight at once. Keep this small to
+# stay polite to the shared KWG endpoint.
+MAX_CONCURRENT_REQUESTS = 4
+
+# Like the requests timeout=600 it replaces, this limits each connect and each
+# socket read, not the whole (possibly very long) streamed download.
+CONSTRUCT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)
+
+# A batched CONSTRUCT over all counties can take much longer to plan before
+# the first byte arrives, so --combined gets a longer read limit.
+COMBINED_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=1800)
+
+# Retry policy for HTTP 429 (Too Many Requests) responses.
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+
+# The county list is cached here and reused until it is older than the TTL.
+COUNTIES_CACHE = OUT_DIR / "_counties.json"
+COUNTIES_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Prefix of the file written by --combined, which fetches every county in one
+# batched CONSTRUCT. See combined_stem for the full name.
+COMBINED_STEM = "cropland_maine_all_counties"
+
+# Response bodies are streamed to disk in chunks of this size.
+CHUNK_SIZE = 64 * 1024
+
+# Bytes (after any leading whitespace) checked at the start of a response to
+# detect HTML error pages.
+SNIFF_BYTES = 512
+
+# Output is zstd-compressed (.ttl.zst) unless --uncompressed is given.
+# Read it back with zstd.ZstdDecompressor().stream_reader(f).
+ZSTD_LEVEL = 3
+
+# Shared keep-alive session for the synchronous (SELECT) requests. SPARQL
+# queries are read-only, so POST is safe to retry here.
+SESSION = requests.Session()
+SESSION.verify = CA_BUNDLE
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+        ),
+    ),
+)
+
+_NONALNUM = re.compile(r"[^a-z0-9]+")
+_MULTI_UNDERSCORE = re.compile(r"_+")
+_FIPS_RE = re.compile(r"administrativeRegion\.USA\.(\d+)$")
 
 
 def safe_filename(s: str) -> str:
     """Turn a label into a safe filename."""
     s = s.strip().lower()
     s = s.replace("&", "and")
-    s = re.sub(r"[^a-z0-9]+", "_", s)
-    s = re.sub(r"_+", "_", s).strip("_")
+    s = _NONALNUM.sub("_", s)
+    s = _MULTI_UNDERSCORE.sub("_", s).strip("_")
     return s or "unknown_county"
 
 
 def run_select(query: str) -> dict:
     """Run a SELECT query and return JSON results."""
-    resp = requests.post(
+    resp = SESSION.post(
         KWG_ENDPOINT,
         data={"query": query},
         headers=HEADERS_JSON,
-        verify=VERIFY_SSL,
         timeout=300,
     )
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
 
 
-def run_construct(query: str) -> str:
-    """Run a CONSTRUCT query and return Turtle text."""
-    resp = requests.post(
-        KWG_ENDPOINT,
-        data={"query": query},
-        headers=HEADERS_TTL,
-        verify=VERIFY_SSL,
-        timeout=600,
-    )
-    resp.raise_for_status()
-    return resp.text
+def looks_like_html(head: bytes) -> bool:
+    """True if a response body starts like an HTML page rather than Turtle."""
+    head = head.lstrip()[:SNIFF_BYTES].lower()
+    return head.startswith(b"<!doctype html") or b"<html" in head
+
 
+async def fetch_construct(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    query: str,
+    out_path: Path,
+    timeout: aiohttp.ClientTimeout = CONSTRUCT_TIMEOUT,
+) -> tuple[int, str] | None:
+    """Run a CONSTRUCT query and stream the Turtle response to out_path.
 
-def get_maine_counties():
+    If out_path ends in .zst the body is zstd-compressed on the way to disk.
+    The body is written to a .part file and renamed when complete, so an
+    interrupted download never leaves a truncated out_path behind.
+    Returns (Turtle bytes received, response Content-Encoding), or None if the
+    server answered with an HTML page instead of Turtle. The first SNIFF_BYTES
+    past any leading whitespace are checked before the output file is opened,
+    so an error page never reaches disk.
+
+    The caller's semaphore caps how many calls are in flight at once. HTTP 429
+    responses are retried with exponential backoff (honouring Retry-After).
+    """
+    async with sem:
+        for attempt in range(MAX_RETRIES + 1):
+            async with session.post(
+                KWG_ENDPOINT,
+                data={"query": query},
+                headers=HEADERS_TTL,
+                ssl=SSL_CONTEXT,
+                timeout=timeout,
+            ) as resp:
+                if resp.status == 429 and attempt < MAX_RETRIES:
+                    retry_after = resp.headers.get("Retry-After", "")
+                    delay = float(retry_after) if retry_after.isdigit() else BACKOFF_BASE_SECONDS * 2 ** attempt
+                    await asyncio.sleep(delay)
+                    continue
+                if resp.status >= 400:
+                    body = await resp.content.read(1000)
+                    raise aiohttp.ClientResponseError(
+                        resp.request_info,
+                        resp.history,
+                        status=resp.status,
+                        message=body.decode("utf-8", errors="replace"),
+                    )
+
+                # If server returned HTML error page, stop before touching disk
+                head = b""
+                while len(head.lstrip()) < SNIFF_BYTES:
+                    chunk = await resp.content.read(SNIFF_BYTES)
+                    if not chunk:
+                        break
+                    head += chunk
+                if looks_like_html(head):
+                    resp.close()
+                    return None
+
+                compressor = None
+                if out_path.suffix == ".zst":
+                    compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+                part_path = out_path.with_name(out_path.name + ".part")
+                written = 0
+                try:
+                    async with aiofiles.open(part_path, "wb") as f:
+                        chunk = head
+                        while chunk:
+                            written += len(chunk)
+                            if compressor is not None:
+                                chunk = compressor.compress(chunk)
+                            await f.write(chunk)
+                            chunk = await resp.content.read(CHUNK_SIZE)
+                        if compressor is not None:
+                            await f.write(compressor.flush())
+                    part_path.replace(out_path)
+                except BaseException:
+                    # Don't leave a half-written .part file behind
+                    part_path.unlink(missing_ok=True)
+                    raise
+                return written, resp.headers.get("Content-Encoding", "identity")
+
+
+def get_maine_counties(refresh: bool = False):
+    """Return (county_iri, label, fips, safe_label) tuples for Maine counties.
+
+    The (county_iri, label) pairs come from the on-disk cache when it is fresh;
+    fips and safe_label are derived from them once here.
+    """
+    pairs = None
+    if not refresh and COUNTIES_CACHE.exists():
+        age = time.time() - COUNTIES_CACHE.stat().st_mtime
+        if age < COUNTIES_CACHE_TTL_SECONDS:
+            try:
+                with COUNTIES_CACHE.open(encoding="utf-8") as f:
+                    pairs = json.load(f)
+                # Expect a list of [county_iri, label] string pairs
+                if not isinstance(pairs, list) or not all(
+                    isinstance(p, list) and len(p) == 2 and all(isinstance(v, str) for v in p) for p in pairs
+                ):
+                    raise ValueError("unexpected structure")
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable county cache {COUNTIES_CACHE.name}: {e}")
+                pairs = None
+
+    if not pairs:
+        pairs = query_maine_counties()
+        # Write atomically, and never cache an empty result
+        if pairs:
+            tmp_path = COUNTIES_CACHE.with_name(COUNTIES_CACHE.name + ".tmp")
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump(pairs, f)
+            tmp_path.replace(COUNTIES_CACHE)
+
+    return [(iri, label, extract_fips_from_iri(iri), safe_filename(label)) for iri, label in pairs]
+
+
+def query_maine_counties():
     # Counties are modeled as admin regions that are administrativePartOf Maine (USA.23)
     # Labels look like "Androscoggin County, Maine"
     q = """
@@ -80,7 +257,16 @@ ORDER BY ?label
 
 
 def construct_for_county(county_iri: str) -> str:
-    # CONSTRUCT, parameterized by the county IRI
+    return construct_for_counties([county_iri])
+
+
+def construct_for_counties(county_iris) -> str:
+    # CONSTRUCT, parameterized by a VALUES block of county IRIs. When several
+    # counties are batched, the head also emits which county contains each S2
+    # cell so the combined output can still be attributed (or split) per county.
+    county_iris = list(county_iris)
+    values = " ".join(f"<{iri}>" for iri in county_iris)
+    county_head = "?county kwg-ont:sfContains ?s2Cell .\n    " if len(county_iris) > 1 else ""
     return f"""
 PREFIX owl: <http://www.w3.org/2002/07/owl#>
 PREFIX kwg-ont: <http://stko-kwg.geog.ucsb.edu/lod/ontology/>
@@ -90,7 +276,7 @@ PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
 
 CONSTRUCT {{
-    ?s2Cell sosa:isFeatureOfInterestOf ?croplandObsCollection .
+    {county_head}?s2Cell sosa:isFeatureOfInterestOf ?croplandObsCollection .
     ?croplandObsCollection rdf:type kwg-ont:CroplandS2OverlapObservationCollection .
     ?croplandObsCollection rdfs:label ?label .
     ?croplandObsCollection sosa:phenomenonTime ?kwgrInstant .
@@ -101,7 +287,8 @@ CONSTRUCT {{
     ?CroplandS2OverlapObservation sosa:hasSimpleResult ?sosaSimpleResult .
 }}
 WHERE {{
-    <{county_iri}> kwg-ont:sfContains ?s2Cell .
+    VALUES ?county {{ {values} }}
+    ?county kwg-ont:sfContains ?s2Cell .
     ?s2Cell sosa:isFeatureOfInterestOf ?croplandObsCollection .
     ?croplandObsCollection rdf:type kwg-ont:CroplandS2OverlapObservationCollection .
     ?croplandObsCollection rdfs:label ?label .
@@ -117,47 +304,148 @@ WHERE {{
 
 def extract_fips_from_iri(county_iri: str) -> str:
     # Example: .../administrativeRegion.USA.23001 -> "23001"
-    m = re.search(r"administrativeRegion\.USA\.(\d+)$", county_iri)
+    m = _FIPS_RE.search(county_iri)
     return m.group(1) if m else "unknown"
 
 
-def main():
-    print(f"Output directory: {OUT_DIR}")
-    print("Fetching Maine counties...")
-    counties = get_maine_counties()
-    print(f"Found {len(counties)} counties.")
+def output_path(stem: str, compress: bool) -> Path:
+    """Path in OUT_DIR for a Turtle export, with .zst appended when compressing."""
+    return OUT_DIR / (f"{stem}.ttl.zst" if compress else f"{stem}.ttl")
+
+
+def combined_stem(counties) -> str:
+    """File stem for a batched export, identifying the exact set of counties.
+
+    The county count and a short hash of the sorted FIPS codes are included so
+    that a file written for a different set of counties is never mistaken for
+    this one by the skip-if-exists check.
+    """
+    fips = ",".join(sorted(county[2] for county in counties))
+    digest = hashlib.sha1(fips.encode("utf-8")).hexdigest()[:8]
+    return f"{COMBINED_STEM}_{len(counties)}_{digest}"
+
+
+async def save_construct(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    query: str,
+    out_path: Path,
+    name: str,
+    overwrite: bool = False,
+    timeout: aiohttp.ClientTimeout = CONSTRUCT_TIMEOUT,
+) -> str | None:
+    """Run a CONSTRUCT into out_path, reporting errors under name.
+
+    Returns None on success, otherwise a short reason for the failure (which
+    has already been printed). Unless overwrite is set, a non-empty out_path
+    from an earlier run is kept and the query is skipped.
+    """
+    if not overwrite and out_path.exists() and out_path.stat().st_size > 0:
+        print(f"  Skipping {name}: {out_path.name} already exists")
+        return None
+
+    try:
+        result = await fetch_construct(session, sem, query, out_path, timeout)
+    except aiohttp.ClientResponseError as e:
+        # Print server response for debugging
+        print(f"  ERROR [{name}]: HTTP {e.status}")
+        print(e.message)
+        return f"HTTP {e.status}"
+    except Exception as e:
+        reason = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        print(f"  ERROR [{name}]: {reason}")
+        return reason
+
+    if result is None:
+        print(f"  ERROR [{name}]: Looks like HTML (not Turtle). Not saving.")
+        return "HTML response instead of Turtle"
+
+    received, encoding = result
+    received_kb = received / 1024
+    size_kb = out_path.stat().st_size / 1024
+    print(
+        f"  Saved {name} -> {out_path.name} "
+        f"({received_kb:.1f} KB Turtle, {size_kb:.1f} KB on disk, Content-Encoding {encoding})"
+    )
+    return None
+
+
+async def export_county(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    county,
+    compress: bool = True,
+    overwrite: bool = False,
+) -> None:
+    """Fetch the cropland CONSTRUCT for one county and save it as Turtle."""
+    county_iri, label, fips, safe_label = county
+    out_path = output_path(f"cropland_{safe_label}_{fips}", compress)
+    query = construct_for_county(county_iri)
+    await save_construct(session, sem, query, out_path, f"{label} ({county_iri})", overwrite)
+
 
-    
-    for i, (county_iri, label) in enumerate(counties, start=1):
-        fips = extract_fips_from_iri(county_iri)
-        fname = f"cropland_{safe_filename(label)}_{fips}.ttl"
-        out_path = OUT_DIR / fname
+async def export_counties(
+    counties,
+    combined: bool = False,
+    compress: bool = True,
+    max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+    overwrite: bool = False,
+) -> None:
+    """Export the given counties, as returned by get_maine_counties.
 
-        print(f"[{i}/{len(counties)}] Exporting {label} ({county_iri}) -> {out_path.name}")
+    By default each county gets its own file and up to max_concurrent
+    CONSTRUCTs run at once. With combined=True and more than one county, a
+    single batched CONSTRUCT covers every county and is written to one
+    combined_stem file; if the endpoint rejects the batch, this falls back to
+    per-county requests.
+    Existing output files are skipped unless overwrite is set.
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+    connector = aiohttp.TCPConnector(limit=max_concurrent)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if combined and len(counties) > 1:
+            query = construct_for_counties(county[0] for county in counties)
+            name = f"{len(counties)} counties"
+            out_path = output_path(combined_stem(counties), compress)
+            error = await save_construct(session, sem, query, out_path, name, overwrite, COMBINED_TIMEOUT)
+            if error is None:
+                return
+            print(f"Batched CONSTRUCT failed ({error}); falling back to one request per county.")
 
-        q = construct_for_county(county_iri)
+        await asyncio.gather(
+            *(export_county(session, sem, county, compress, overwrite) for county in counties)
+        )
 
-        try:
-            ttl_text = run_construct(q)
-        except requests.HTTPError as e:
-            # Print server response for debugging
-            print(f"  ERROR: HTTP {e.response.status_code}")
-            print(e.response.text[:1000])
-            continue
-        except Exception as e:
-            print(f"  ERROR: {e}")
-            continue
 
-        # If server returned HTML error page, don't save as TTL
-        if ttl_text.lstrip().lower().startswith("<!doctype html") or "<html" in ttl_text[:200].lower():
-            print("  ERROR: Looks like HTML (not Turtle). Not saving.")
-            continue
+def main(
+    target_fips: str | None = None,
+    refresh_counties: bool = False,
+    combined: bool = False,
+    compress: bool = True,
+    max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+    overwrite: bool = False,
+):
+    print(f"Output directory: {OUT_DIR}")
+    print("Fetching Maine counties...")
+    counties = get_maine_counties(refresh=refresh_counties)
+    print(f"Found {len(counties)} counties.")
 
-        out_path.write_text(ttl_text, encoding="utf-8")
-        print(f"  Saved {out_path.stat().st_size / 1024:.1f} KB")
+    if target_fips is not None:
+        counties = [county for county in counties if county[2] == target_fips]
+        if not counties:
+            print(f"No county found for FIPS {target_fips}")
+            sys.exit(1)
+        counties = counties[:1]
 
-    
-        time.sleep(0.3)
+    asyncio.run(
+        export_counties(
+            counties,
+            combined=combined,
+            compress=compress,
+            max_concurrent=max_concurrent,
+            overwrite=overwrite,
+        )
+    )
 
     print("Done.")
 
@@ -165,19 +453,42 @@ def main():
 if __name__ == "__main__":
     # to export just one county by FIPS:
     #   python export_kwg_cropland_by_county.py 23001
-    if len(sys.argv) == 2:
-        target_fips = sys.argv[1].strip()
-        counties = get_maine_counties()
-        match = [(iri, lbl) for iri, lbl in counties if extract_fips_from_iri(iri) == target_fips]
-        if not match:
-            print(f"No county found for FIPS {target_fips}")
-            sys.exit(1)
-        county_iri, label = match[0]
-        OUT_DIR.mkdir(parents=True, exist_ok=True)
-        out_path = OUT_DIR / f"cropland_{safe_filename(label)}_{target_fips}.ttl"
-        ttl_text = run_construct(construct_for_county(county_iri))
-        out_path.write_text(ttl_text, encoding="utf-8")
-        print(f"Saved {out_path}")
-    else:
-        main()
-
+    parser = argparse.ArgumentParser(description="Export KWG cropland observations for Maine counties as Turtle.")
+    parser.add_argument("fips", nargs="?", help="export only the county with this FIPS code (e.g. 23001)")
+    parser.add_argument(
+        "--refresh-counties",
+        action="store_true",
+        help="ignore the cached county list and re-query the endpoint",
+    )
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help=f"fetch all counties in one batched CONSTRUCT and save them to {COMBINED_STEM}_<n>_<hash>.ttl[.zst]",
+    )
+    parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        help="write plain .ttl files instead of zstd-compressed .ttl.zst",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=MAX_CONCURRENT_REQUESTS,
+        help=f"CONSTRUCT requests in flight at once (default {MAX_CONCURRENT_REQUESTS}); lower it to go easier on KWG",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="re-download counties whose output file already exists",
+    )
+    args = parser.parse_args()
+    if args.combined and args.fips:
+        parser.error("--combined exports all counties and cannot be used with a FIPS code")
+    main(
+        target_fips=args.fips.strip() if args.fips else None,
+        refresh_counties=args.refresh_counties,
+        combined=args.combined,
+        compress=not args.uncompressed,
+        max_concurrent=max(1, args.max_concurrent),
+        overwrite=args.overwrite,
+    )
@@ -1,7 +1,7 @@
 import pandas as pd
 
-# Load CSV
-df = pd.read_csv("Crop_Category_mapping.csv")
+# Load CSV: only the code (0), category (2) and sub-category (3) columns, as strings
+df = pd.read_csv("Crop_Category_mapping.csv", usecols=[0, 2, 3], dtype=str)
 
 # Define prefixes
 prefixes = """@prefix ag: <http://w3id.org/sawgraph/v1/ag#> .
@@ -12,67 +12,76 @@ prefixes = """@prefix ag: <http://w3id.org/sawgraph/v1/ag#> .
 
 """
 
-triples = [prefixes]
+
+def clean_column(col):
+    """Strip a column and remove inner spaces; missing or blank cells become "".
+
+    Categories repeat across many rows, so each distinct raw value is cleaned
+    once and the rows are mapped through that lookup.
+    """
+    present = col.dropna()
+    normalized = {raw: raw.strip().replace(" ", "") for raw in present.unique()}
+    return present.map(normalized).reindex(col.index, fill_value="")
+
+
+def unique_sorted(col):
+    """Distinct non-blank values of a cleaned column, in sorted order."""
+    return col[col != ""].drop_duplicates().sort_values().to_numpy()
+
+
+# Extract the columns we need once, as plain strings
+obs_ids = df.iloc[:, 0].astype(str).str.strip()
+crop_category_col = clean_column(df.iloc[:, 1])
+crop_subcategory_col = clean_column(df.iloc[:, 2])
 
 # Collect unique crop categories and subcategories
-crop_categories = set()
-crop_subcategories = set()
-
-for _, row in df.iterrows():
-    crop_category = str(row[2]).strip() if pd.notna(row[2]) else None
-    crop_subcategory = str(row[3]).strip() if pd.notna(row[3]) else None
-
-    if crop_category:
-        crop_categories.add(crop_category.replace(" ", ""))
-    if crop_subcategory:
-        crop_subcategories.add(crop_subcategory.replace(" ", ""))
-
-# Define all unique crop categories
-for category in sorted(crop_categories):
-    triples.append(f"ag:cropCategory.{category} a ag:cropCategory,")
-    triples.append("        owl:NamedIndividual ;")
-    triples.append(f'    rdfs:label "Crop Category for {category}"^^xsd:string .\n')
-
-# Define all unique crop subcategories
-for subcat in sorted(crop_subcategories):
-    triples.append(f"ag:cropSubCategory.{subcat} a ag:cropSubCategory,")
-    triples.append("        owl:NamedIndividual ;")
-    triples.append(f'    rdfs:label "Crop Sub Category for {subcat}"^^xsd:string .\n')
-
-# Add the class definitions (as in your example)
-triples.append("ag:cropCategory rdf:type owl:Class ;")
-triples.append('                         rdfs:label "Crop Category" .\n')
-
-triples.append("ag:cropSubCategory rdf:type owl:Class ;")
-triples.append('                         rdfs:label "Crop Sub-Category" ;')
-triples.append("		   rdfs:subClassOf ag:cropCategory .\n")
-
-# Generate triples for each observable property
-for _, row in df.iterrows():
-    obs_id = str(row[0]).strip()
-    crop_category = str(row[2]).strip() if pd.notna(row[2]) else None
-    crop_subcategory = str(row[3]).strip() if pd.notna(row[3]) else None
-
-    # Skip if no observable property ID
-    if not obs_id:
-        continue
-
-    # Build property triple
-    property_triple = f"kwgr:croplandObservableProperty.{obs_id}"
-
-    relations = []
-    if crop_category:
-        relations.append(f"ag:hasCropCategory ag:cropCategory.{crop_category.replace(' ', '')}")
-    if crop_subcategory:
-        relations.append(f"ag:hasCropSubCategory ag:cropSubCategory.{crop_subcategory.replace(' ', '')}")
-
-    # Only write if there's at least one valid relation
-    if relations:
-        triples.append(f"{property_triple} " + " ;\n                                 ".join(relations) + " .\n")
-
-# Write to TTL file
-with open("crop_triples.ttl", "w") as f:
-    f.write("\n".join(triples))
+crop_categories = unique_sorted(crop_category_col)
+crop_subcategories = unique_sorted(crop_subcategory_col)
+
+# Write to TTL file, one block at a time
+with open("crop_triples.ttl", "w", buffering=1 << 16, encoding="utf-8") as f:
+    f.write(prefixes + "\n")
+
+    # Define all unique crop categories
+    for category in crop_categories:
+        f.write(
+            f"ag:cropCategory.{category} a ag:cropCategory,\n"
+            "        owl:NamedIndividual ;\n"
+            f'    rdfs:label "Crop Category for {category}"^^xsd:string .\n\n'
+        )
+
+    # Define all unique crop subcategories
+    for subcat in crop_subcategories:
+        f.write(
+            f"ag:cropSubCategory.{subcat} a ag:cropSubCategory,\n"
+            "        owl:NamedIndividual ;\n"
+            f'    rdfs:label "Crop Sub Category for {subcat}"^^xsd:string .\n\n'
+        )
+
+    # Add the class definitions (as in your example)
+    f.write(
+        "ag:cropCategory rdf:type owl:Class ;\n"
+        '                         rdfs:label "Crop Category" .\n\n'
+    )
+    f.write(
+        "ag:cropSubCategory rdf:type owl:Class ;\n"
+        '                         rdfs:label "Crop Sub-Category" ;\n'
+        "\t\t   rdfs:subClassOf ag:cropCategory .\n\n"
+    )
+
+    # Generate triples for each observable property
+    has_category = crop_category_col != ""
+    has_subcategory = crop_subcategory_col != ""
+    relation_blocks = (
+        ("ag:hasCropCategory ag:cropCategory." + crop_category_col).where(has_category, "")
+        + (has_category & has_subcategory).map({True: " ;\n                                 ", False: ""})
+        + ("ag:hasCropSubCategory ag:cropSubCategory." + crop_subcategory_col).where(has_subcategory, "")
+    )
+
+    # Skip rows without an observable property ID or without any valid relation
+    keep = (obs_ids != "") & (has_category | has_subcategory)
+    for obs_id, relation_block in zip(obs_ids[keep].to_numpy(), relation_blocks[keep].to_numpy()):
+        f.write(f"kwgr:croplandObservableProperty.{obs_id} {relation_block} .\n\n")
 
 print("✅ RDF triples successfully generated and saved to 'crop_category_triples.ttl'")
 